@@ -0,0 +1,210 @@
+"""Admission control and load shedding for the composite service
+
+- every user gets a token bucket of requests (keyed by JWT subject, user_id, or client address),
+  public high priority writes (save and unsave a route) are exempt since they carry no user to key on,
+  protected writes are rate limited by their JWT subject
+- upstream calls (Google Map, route history, and MTA services) share a global cap of in-flight calls
+- when upstream calls queue up, low priority requests are shed before high priority ones
+"""
+import asyncio
+import math
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "2"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_MAX_USERS = 10000
+MAX_INFLIGHT_UPSTREAM = int(os.getenv("MAX_INFLIGHT_UPSTREAM", "32"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "2"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))  # seconds per upstream call
+SHED_RETRY_AFTER = 1  # seconds
+
+
+# request priorities, paths that are not listed are not subject to admission control
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+ENDPOINT_PRIORITY = {
+    "/save-route/": PRIORITY_HIGH,
+    "/unsave-route/": PRIORITY_HIGH,
+    "/query-routes-and-stations/": PRIORITY_NORMAL,
+    "/query-all-routes-by-user/": PRIORITY_NORMAL,
+    # one call can fan out to dozens of MTA requests
+    "/get-saved-routes-and-stations/": PRIORITY_LOW,
+}
+ENDPOINT_PRIORITY.update({
+    f"/protected-{path.lstrip('/')}": priority for path, priority in list(ENDPOINT_PRIORITY.items())
+})
+# requests are shed once the upstream load (in-flight and queued calls / MAX_INFLIGHT_UPSTREAM)
+# reaches the threshold of their priority; high priority requests are never shed
+SHED_LOAD_THRESHOLD = {
+    PRIORITY_LOW: 1.0,
+    PRIORITY_NORMAL: 1.5,
+}
+
+
+# counters exposed on /metrics/
+metrics: Counter = Counter()
+
+
+class TokenBucket:
+    """Token bucket refilled with rate tokens per second up to burst tokens"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> float:
+        """Take one token
+        Return 0 if the token is taken, otherwise the seconds until a token is available
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+_buckets: Dict[str, TokenBucket] = {}
+
+
+def rate_limit(user_key: str) -> float:
+    """Take a token from the bucket of the user
+    Return 0 if the request is admitted, otherwise the seconds to wait before retrying
+    """
+    bucket = _buckets.get(user_key)
+    if bucket is None:
+        if len(_buckets) >= RATE_LIMIT_MAX_USERS:
+            # full buckets belong to idle users, dropping them does not change any limit
+            idle_keys = []
+            for key, idle_bucket in _buckets.items():
+                idle_bucket.refill()
+                if idle_bucket.tokens >= idle_bucket.burst:
+                    idle_keys.append(key)
+            for key in idle_keys:
+                del _buckets[key]
+        bucket = _buckets[user_key] = TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+    return bucket.take()
+
+
+class UpstreamLimiter:
+    """Global cap on the number of in-flight upstream calls"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(capacity)
+
+    def load(self) -> float:
+        return (self.in_flight + self.waiting) / self.capacity
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a free upstream slot for at most UPSTREAM_QUEUE_TIMEOUT seconds
+        Raise HTTPException 503 if no slot becomes free in time
+        """
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics["upstream_rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Upstream services are overloaded",
+                headers={"Retry-After": str(SHED_RETRY_AFTER)},
+            )
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        metrics["upstream_calls"] += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+
+upstream_limiter = UpstreamLimiter(MAX_INFLIGHT_UPSTREAM)
+# blocking upstream calls get their own threads, one per upstream slot, so that every
+# call counted as in flight is actually running (the default executor has min(32, cpu+4) threads)
+upstream_executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_UPSTREAM, thread_name_prefix="upstream")
+
+
+def upstream_slot():
+    """Context manager to wrap every upstream call with"""
+    return upstream_limiter.slot()
+
+
+async def run_blocking_upstream(func, *args, **kwargs):
+    """Run a blocking upstream call (e.g. requests.get) in an upstream slot and thread"""
+    async with upstream_slot():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(upstream_executor, partial(func, *args, **kwargs))
+
+
+def should_shed(priority: str) -> bool:
+    """Return True if a request of the priority should be shed at the current upstream load"""
+    threshold = SHED_LOAD_THRESHOLD.get(priority)
+    return threshold is not None and upstream_limiter.load() >= threshold
+
+
+def admit(path: str, user_key: Optional[str], client_address: Optional[str]=None) -> Optional[HTTPException]:
+    """Decide whether to admit a request
+    user_key is the JWT subject or user_id of the request, if any, otherwise
+    requests are rate limited by client_address (except high priority ones)
+    Return None if it is admitted, otherwise the 429 or 503 error to respond with
+    """
+    priority = ENDPOINT_PRIORITY.get(path)
+    if priority is None:
+        return None
+
+    if should_shed(priority):
+        metrics[f"shed_{priority}"] += 1
+        return HTTPException(
+            status_code=503,
+            detail="Service is overloaded",
+            headers={"Retry-After": str(SHED_RETRY_AFTER)},
+        )
+
+    # many users can share a client address behind a proxy, do not reject their writes for each other
+    if user_key is None and priority == PRIORITY_HIGH:
+        retry_after = 0
+    else:
+        retry_after = rate_limit(user_key or client_address or "unknown")
+    if retry_after > 0:
+        metrics["rate_limited"] += 1
+        return HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+    metrics[f"admitted_{priority}"] += 1
+    return None
+
+
+def get_metrics() -> Dict[str, float]:
+    """Return the admission counters and the current upstream gauges"""
+    return {
+        **metrics,
+        "upstream_in_flight": upstream_limiter.in_flight,
+        "upstream_waiting": upstream_limiter.waiting,
+        "upstream_capacity": upstream_limiter.capacity,
+    }
@@ -24,7 +24,8 @@ CREATE_SAVED_ROUTE_TABLE_QUERY = """
         destination text not null,
         user_id text not null,
         query_id text not null,
-        route json not null
+        route json null,
+        route_blob longblob null
     );
 """
 
@@ -0,0 +1,100 @@
+"""Response compression and ETag helpers for the composite service"""
+import gzip
+import hashlib
+import os
+from typing import Any, Dict, List, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, fall back to gzip only
+    brotli = None
+
+
+# responses smaller than this are not worth compressing
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+COMPRESSIBLE_MEDIA_TYPES = ("application/json", "text/")
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick the content encoding for the Accept-Encoding header of the request
+    Return "br", "gzip", or None if the client accepts neither
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    wildcard = accepted.get("*", 0.0)
+    candidates = [(accepted.get(coding, wildcard), coding) for coding in supported]
+    # prefer brotli when both are accepted with the same quality
+    quality, coding = max(candidates, key=lambda candidate: candidate[0])
+    return coding if quality > 0 else None
+
+
+def is_compressible(media_type: Optional[str]) -> bool:
+    """Return True if responses of the media type should be compressed"""
+    return media_type is not None and media_type.startswith(COMPRESSIBLE_MEDIA_TYPES)
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    """Compress the response body with the given content encoding"""
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Return the strong ETag of the compressed representation
+    A strong ETag must differ for every content encoding, e.g. "abc" -> "abc-gzip"
+    """
+    return f"{etag[:-1]}-{encoding}\""
+
+
+def digest_saved_routes(saved_routes_info: List[Dict[str, Any]]) -> str:
+    """Return a hash of the saved_route rows (before decoding)"""
+    digest = hashlib.sha256()
+    for saved_route_info in saved_routes_info:
+        for key in sorted(saved_route_info):
+            value = saved_route_info[key]
+            if value is None:
+                value = b""
+            elif not isinstance(value, bytes):
+                value = str(value).encode("utf-8")
+            digest.update(key.encode("utf-8") + b"\0" + value + b"\0")
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def compute_saved_routes_etag(saved_routes_digest: str, equipment_digest: str) -> str:
+    """Compute a strong ETag from the hashes of the saved routes and of their equipment status"""
+    digest = hashlib.sha256(f"{saved_routes_digest}:{equipment_digest}".encode("utf-8"))
+    return f"\"{digest.hexdigest()}\""
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Return True if the If-None-Match header matches the ETag
+    Compare the ETags of all content encodings of the same response as equal.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    suffixes = ("-gzip\"", "-br\"")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip().removeprefix("W/")
+        for suffix in suffixes:
+            if candidate.endswith(suffix):
+                candidate = candidate[:-len(suffix)] + "\""
+                break
+        if candidate == etag:
+            return True
+    return False
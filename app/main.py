@@ -4,9 +4,11 @@ import requests
 import json
 import uuid
 import os
+import asyncio
 
 import uvicorn
 from fastapi import FastAPI, Response, Request, HTTPException
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import structlog
 import pandas as pd
@@ -18,26 +20,58 @@ from utils import (
     get_stations_from_routes, 
     request_to_mta_service, 
     insert_into_table, 
-    INSERT_SAVED_ROUTE_QUERY, 
-    INSERT_SAVED_ROUTE_COL_ORDER, 
+    get_insert_saved_route_query, 
     INSERT_EMAIL_NOTIFICATION_QUERY, 
     delete_in_table, 
     DELETE_SAVED_ROUTE_QUERY, 
     DELETE_EMAIL_NOTIFICATION_QUERY, 
     GET_SAVED_ROUTE_QUERY, 
     query_table, 
+    encode_route, 
+    decode_route, 
+    get_equipment_digest, 
+    request_to_route_history_service, 
+    close_http_client, 
+)
+from realtime import (
+    run_realtime_ingester, 
+    get_live_info_from_routes, 
+    GTFS_RT_FEEDS, 
+)
+from admission import admit, get_metrics, upstream_executor
+from http_cache import (
+    negotiate_encoding, 
+    is_compressible, 
+    compress_body, 
+    encoded_etag, 
+    digest_saved_routes, 
+    compute_saved_routes_etag, 
+    etag_matches, 
+    COMPRESSION_MINIMUM_SIZE, 
 )
 
 app = FastAPI()
-app.add_middleware(
-    CORSMiddleware, 
-    allow_origins=["*"], 
-    allow_headers=["*"], 
-    allow_methods=["*"],
-)
 logger = structlog.getLogger(__name__)
 
 
+realtime_ingester_task = None
+
+
+@app.on_event("startup")
+async def startup():
+    global realtime_ingester_task
+    if GTFS_RT_FEEDS:
+        realtime_ingester_task = asyncio.create_task(run_realtime_ingester())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if realtime_ingester_task is not None:
+        realtime_ingester_task.cancel()
+    await close_http_client()
+    upstream_executor.shutdown(wait=False)
+
+
 @app.middleware("http")
 async def log(request: Request, call_next):
     # before
@@ -52,6 +86,22 @@ async def log(request: Request, call_next):
     return response
 
 
+# Middleware for per-user rate limiting and load shedding
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    # JWT subject for protected routes, otherwise the user_id query parameter or the client address
+    user_key = getattr(request.state, "user", None) or request.query_params.get("user_id")
+    client_address = request.client.host if request.client else None
+    rejection = admit(request.url.path, user_key, client_address)
+    if rejection is not None:
+        return JSONResponse(
+            {"detail": rejection.detail}, 
+            status_code=rejection.status_code, 
+            headers=rejection.headers, 
+        )
+    return await call_next(request)
+
+
 # JWT secret and algorithm
 SECRET_KEY = os.getenv("JWT_SECRET")
 ALGORITHM = "HS256"
@@ -68,6 +118,7 @@ async def jwt_validation_middleware(request: Request, call_next):
         "/save-route/", 
         "/unsave-route/", 
         "/get-saved-routes-and-stations/", 
+        "/metrics/", 
     ]  # Add more public routes if needed
     if request.url.path in public_routes:
         return await call_next(request)
@@ -90,23 +141,77 @@ async def jwt_validation_middleware(request: Request, call_next):
     return await call_next(request)
 
 
+# Middleware for gzip/brotli response compression
+@app.middleware("http")
+async def compression_middleware(request: Request, call_next):
+    response = await call_next(request)
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+
+    # a 304 must carry the ETag of the representation the 200 would have had
+    if response.status_code == 304 and "ETag" in response.headers:
+        response.headers["Vary"] = "Accept-Encoding"
+        if encoding is not None:
+            response.headers["ETag"] = encoded_etag(response.headers["ETag"], encoding)
+        return response
+
+    if (
+        not is_compressible(response.headers.get("Content-Type"))
+        or "Content-Encoding" in response.headers
+        or response.status_code in (204, 304)
+    ):
+        return response
+
+    response.headers["Vary"] = "Accept-Encoding"
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = dict(response.headers)
+    # responses with an ETag are always compressed when an encoding is negotiated,
+    # so that their 304 can tell the ETag of the compressed representation without the body
+    if encoding is not None and (len(body) >= COMPRESSION_MINIMUM_SIZE or "etag" in headers):
+        body = compress_body(body, encoding)
+        headers["content-encoding"] = encoding
+        headers["content-length"] = str(len(body))
+        if "etag" in headers:
+            headers["etag"] = encoded_etag(headers["etag"], encoding)
+    return Response(body, status_code=response.status_code, headers=headers)
+
+
+# the middleware added last runs first, CORS is added after all other middlewares
+# so that responses they return early (e.g. 429 and 503) also carry the CORS headers
+app.add_middleware(
+    CORSMiddleware, 
+    allow_origins=["*"], 
+    allow_headers=["*"], 
+    allow_methods=["*"],
+)
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/metrics/")
+def read_metrics():
+    """Return the admission control counters and upstream call gauges"""
+    return get_metrics()
+
+
 @app.get("/query-routes-and-stations/")
 async def query_routes_and_stations(source: str, destination: str, user_id: str):
     """Query Google Map Service and MTA Service 
     and return a list of routes and a list of stations associated with the route
     for each route. 
+    response["live"] has live train times and alert info from GTFS-realtime feeds 
+    for every TRANSIT step of each route. 
     """
     routes = await request_to_google_maps_service(source, destination, user_id, mode="transit")
-    all_stations, all_transit_types = await get_stations_from_routes(routes["routes"])
-    all_mta_info = await request_to_mta_service(all_stations, all_transit_types)
+    all_stations, all_transit_types, all_resolved_stations = await get_stations_from_routes(routes["routes"])
+    all_mta_info = await request_to_mta_service(all_stations, all_transit_types, all_resolved_stations=all_resolved_stations)
+    all_live_info = get_live_info_from_routes(routes["routes"], all_resolved_stations)
     results = {
         "routes": routes["routes"], 
         "stations": all_mta_info, 
+        "live": all_live_info, 
         "links": routes["_links"], 
         # "query_id": routes["query_id"] ???
     }
@@ -118,12 +223,11 @@ async def query_routes_and_stations(source: str, destination: str, user_id: str)
 async def query_all_routes_by_user(user_id: str, limit: int=10, page: int=1):
     """Retrieve all queries made by the user from the Google Map Service. 
     (with Pagination)
+    Pages are passed through as returned by the Google Map Service, 
+    cached for a short time, and the next page is prefetched in the background.
     """
-    api_endpoint = "http://18.118.121.175"
-    api_endpoint_template = f"{api_endpoint}:5000/viewed_routes/page/{page}?limit={limit}&user_id={user_id}"
-    response = requests.get(api_endpoint_template)
-    results_json = json.dumps(response.json())
-    return Response(results_json, media_type="application/json")
+    status_code, content, media_type = await request_to_route_history_service(user_id, limit, page)
+    return Response(content, status_code=status_code, media_type=media_type)
 
 
 @app.post("/save-route/")
@@ -156,9 +260,10 @@ async def save_route(saved_route: SavedRoute):
     # insert into saved_route table
     saved_route_dict = saved_route.dict()
     saved_route_dict["route_id"] = route_id
-    saved_route_dict["route"] = json.dumps(saved_route_dict["route"])
-    saved_route_data = [tuple([saved_route_dict[key] for key in INSERT_SAVED_ROUTE_COL_ORDER])]
-    await insert_into_table(INSERT_SAVED_ROUTE_QUERY, saved_route_data)
+    saved_route_dict.update(encode_route(saved_route_dict["route"]))
+    insert_saved_route_query, insert_saved_route_col_order = get_insert_saved_route_query()
+    saved_route_data = [tuple([saved_route_dict[key] for key in insert_saved_route_col_order])]
+    await insert_into_table(insert_saved_route_query, saved_route_data)
 
     # insert into email_notification table
     notification_id = str(uuid.uuid4())
@@ -236,25 +341,52 @@ def unsave_route(route_id: str):
 
 
 @app.get("/get-saved-routes-and-stations/")
-async def get_saved_routes_and_stations(user_id: str):
+async def get_saved_routes_and_stations(user_id: str, request: Request):
     """Get all saved routes and stations saved by the users previously
     1. Query the database to get saved routes for the user
     2. Retrieve stations from the saved routes and get status of stations
     The returned list of saved_routes and the list of list of station_from_saved_routes
     have a one-to-one mapping relationship.
+    The response carries an ETag of the saved routes and the equipment status snapshot,
+    a request with a matching If-None-Match header returns 304, without querying the MTA service 
+    while the cached equipment status of the stations is fresh. 
     """
     saved_routes_info = await query_table(GET_SAVED_ROUTE_QUERY, user_id)
+    saved_routes_digest = digest_saved_routes(saved_routes_info)
     for saved_routes_info_i in saved_routes_info:
-        saved_routes_info_i["route"] = json.loads(saved_routes_info_i["route"])
+        decode_route(saved_routes_info_i)
     saved_routes_only = [d["route"] for d in saved_routes_info]
-    saved_routes_stations, saved_routes_transit_types = await get_stations_from_routes(saved_routes_only)
-    saved_routes_mta_info = await request_to_mta_service(saved_routes_stations, saved_routes_transit_types)
+    saved_routes_stations, saved_routes_transit_types, saved_routes_resolved_stations = await get_stations_from_routes(saved_routes_only)
+
+    equipment_digest = get_equipment_digest(saved_routes_stations, saved_routes_transit_types, saved_routes_resolved_stations)
+    if equipment_digest is not None:
+        etag = compute_saved_routes_etag(saved_routes_digest, equipment_digest)
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    saved_routes_mta_info = await request_to_mta_service(
+        saved_routes_stations, 
+        saved_routes_transit_types, 
+        all_resolved_stations=saved_routes_resolved_stations, 
+    )
+    # stale stations are refreshed, the ETag only changes if their equipment status did
+    equipment_digest = get_equipment_digest(
+        saved_routes_stations, 
+        saved_routes_transit_types, 
+        saved_routes_resolved_stations, 
+        require_fresh=False, 
+    )
+    etag = compute_saved_routes_etag(saved_routes_digest, equipment_digest)
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+
     results = {
         "saved_routes": saved_routes_info, 
         "stations_from_saved_routes": saved_routes_mta_info, 
     }
     results_json = json.dumps(results)
-    return Response(results_json, media_type="application/json")
+    return Response(results_json, media_type="application/json", headers=cache_headers)
 
 
 ## ------------ Protected route ------------
@@ -263,13 +395,17 @@ async def protected_query_routes_and_stations(source: str, destination: str, use
     """Query Google Map Service and MTA Service 
     and return a list of routes and a list of stations associated with the route
     for each route. 
+    response["live"] has live train times and alert info from GTFS-realtime feeds 
+    for every TRANSIT step of each route. 
     """
     routes = await request_to_google_maps_service(source, destination, user_id, mode="transit")
-    all_stations, all_transit_types = await get_stations_from_routes(routes["routes"])
-    all_mta_info = await request_to_mta_service(all_stations, all_transit_types)
+    all_stations, all_transit_types, all_resolved_stations = await get_stations_from_routes(routes["routes"])
+    all_mta_info = await request_to_mta_service(all_stations, all_transit_types, all_resolved_stations=all_resolved_stations)
+    all_live_info = get_live_info_from_routes(routes["routes"], all_resolved_stations)
     results = {
         "routes": routes["routes"], 
         "stations": all_mta_info, 
+        "live": all_live_info, 
         "links": routes["_links"], 
         # "query_id": routes["query_id"] ???
     }
@@ -281,12 +417,11 @@ async def protected_query_routes_and_stations(source: str, destination: str, use
 async def protected_query_all_routes_by_user(user_id: str, limit: int=10, page: int=1):
     """Retrieve all queries made by the user from the Google Map Service. 
     (with Pagination)
+    Pages are passed through as returned by the Google Map Service, 
+    cached for a short time, and the next page is prefetched in the background.
     """
-    api_endpoint = "http://18.118.121.175"
-    api_endpoint_template = f"{api_endpoint}:5000/viewed_routes/page/{page}?limit={limit}&user_id={user_id}"
-    response = requests.get(api_endpoint_template)
-    results_json = json.dumps(response.json())
-    return Response(results_json, media_type="application/json")
+    status_code, content, media_type = await request_to_route_history_service(user_id, limit, page)
+    return Response(content, status_code=status_code, media_type=media_type)
 
 
 @app.post("/protected-save-route/")
@@ -319,9 +454,10 @@ async def protected_save_route(saved_route: SavedRoute):
     # insert into saved_route table
     saved_route_dict = saved_route.dict()
     saved_route_dict["route_id"] = route_id
-    saved_route_dict["route"] = json.dumps(saved_route_dict["route"])
-    saved_route_data = [tuple([saved_route_dict[key] for key in INSERT_SAVED_ROUTE_COL_ORDER])]
-    await insert_into_table(INSERT_SAVED_ROUTE_QUERY, saved_route_data)
+    saved_route_dict.update(encode_route(saved_route_dict["route"]))
+    insert_saved_route_query, insert_saved_route_col_order = get_insert_saved_route_query()
+    saved_route_data = [tuple([saved_route_dict[key] for key in insert_saved_route_col_order])]
+    await insert_into_table(insert_saved_route_query, saved_route_data)
 
     # insert into email_notification table
     notification_id = str(uuid.uuid4())
@@ -399,25 +535,52 @@ def protected_unsave_route(route_id: str):
 
 
 @app.get("/protected-get-saved-routes-and-stations/")
-async def protected_get_saved_routes_and_stations(user_id: str):
+async def protected_get_saved_routes_and_stations(user_id: str, request: Request):
     """Get all saved routes and stations saved by the users previously
     1. Query the database to get saved routes for the user
     2. Retrieve stations from the saved routes and get status of stations
     The returned list of saved_routes and the list of list of station_from_saved_routes
     have a one-to-one mapping relationship.
+    The response carries an ETag of the saved routes and the equipment status snapshot,
+    a request with a matching If-None-Match header returns 304, without querying the MTA service 
+    while the cached equipment status of the stations is fresh. 
     """
     saved_routes_info = await query_table(GET_SAVED_ROUTE_QUERY, user_id)
+    saved_routes_digest = digest_saved_routes(saved_routes_info)
     for saved_routes_info_i in saved_routes_info:
-        saved_routes_info_i["route"] = json.loads(saved_routes_info_i["route"])
+        decode_route(saved_routes_info_i)
     saved_routes_only = [d["route"] for d in saved_routes_info]
-    saved_routes_stations, saved_routes_transit_types = await get_stations_from_routes(saved_routes_only)
-    saved_routes_mta_info = await request_to_mta_service(saved_routes_stations, saved_routes_transit_types)
+    saved_routes_stations, saved_routes_transit_types, saved_routes_resolved_stations = await get_stations_from_routes(saved_routes_only)
+
+    equipment_digest = get_equipment_digest(saved_routes_stations, saved_routes_transit_types, saved_routes_resolved_stations)
+    if equipment_digest is not None:
+        etag = compute_saved_routes_etag(saved_routes_digest, equipment_digest)
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    saved_routes_mta_info = await request_to_mta_service(
+        saved_routes_stations, 
+        saved_routes_transit_types, 
+        all_resolved_stations=saved_routes_resolved_stations, 
+    )
+    # stale stations are refreshed, the ETag only changes if their equipment status did
+    equipment_digest = get_equipment_digest(
+        saved_routes_stations, 
+        saved_routes_transit_types, 
+        saved_routes_resolved_stations, 
+        require_fresh=False, 
+    )
+    etag = compute_saved_routes_etag(saved_routes_digest, equipment_digest)
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+
     results = {
         "saved_routes": saved_routes_info, 
         "stations_from_saved_routes": saved_routes_mta_info, 
     }
     results_json = json.dumps(results)
-    return Response(results_json, media_type="application/json")
+    return Response(results_json, media_type="application/json", headers=cache_headers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""Migrate saved_route.route into the compressed saved_route.route_blob column
+
+Usage:
+    python migrate.py add-column  # add the route_blob column, run before enabling ROUTE_STORAGE_FORMAT=zlib
+    python migrate.py compress    # compress existing rows into route_blob, requires ROUTE_STORAGE_FORMAT=zlib
+"""
+import os
+import sys
+
+import pymysql
+import structlog
+
+from utils import compress_route_json, ROUTE_STORAGE_FORMAT
+
+
+logger = structlog.getLogger(__name__)
+
+
+BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))
+
+
+ADD_ROUTE_BLOB_COLUMN_QUERY = """
+    alter table saved_route
+        modify route json null,
+        add column route_blob longblob null;
+"""
+
+
+ROUTE_BLOB_COLUMN_EXISTS_QUERY = """
+    SELECT COUNT(*) FROM information_schema.columns
+    WHERE table_schema = DATABASE()
+        AND table_name = 'saved_route'
+        AND column_name = 'route_blob';
+"""
+
+
+SELECT_UNCOMPRESSED_ROUTES_QUERY = """
+    SELECT route_id, route FROM saved_route
+    WHERE route_blob IS NULL AND route IS NOT NULL
+    LIMIT %s;
+"""
+
+
+UPDATE_ROUTE_BLOB_QUERY = """
+    UPDATE saved_route
+    SET route_blob = %s, route = NULL
+    WHERE route_id = %s;
+"""
+
+
+if __name__ == "__main__":
+    step = sys.argv[1] if len(sys.argv) > 1 else ""
+    if step not in ("add-column", "compress"):
+        sys.exit(__doc__)
+    if step == "compress" and ROUTE_STORAGE_FORMAT != "zlib":
+        sys.exit("Set ROUTE_STORAGE_FORMAT=zlib before compressing existing saved routes.")
+
+    conn = None
+    try:
+        config = {
+            "host": os.environ["DBHOST"],
+            "user": os.environ["DBUSER"],
+            "password": os.environ["DBPASSWORD"],
+            "port": int(os.environ["DBPORT"]),
+            "db": os.environ["DBNAME"],
+        }
+        conn = pymysql.connect(**config)
+        logger.info("Connected to database.")
+
+        cursor = conn.cursor()
+
+        ## --- add route_blob column ---
+        cursor.execute(ROUTE_BLOB_COLUMN_EXISTS_QUERY)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(ADD_ROUTE_BLOB_COLUMN_QUERY)
+            conn.commit()
+            logger.info("Added route_blob column to saved_route table.")
+        ## ------------------------
+
+        ## --- rewrite existing rows in batches ---
+        # every batch only selects rows that are not migrated yet,
+        # so the migration can be stopped and resumed at any time
+        num_migrated = 0
+        while step == "compress":
+            cursor.execute(SELECT_UNCOMPRESSED_ROUTES_QUERY, (BATCH_SIZE, ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            update_data = [(compress_route_json(route), route_id) for route_id, route in rows]
+            cursor.executemany(UPDATE_ROUTE_BLOB_QUERY, update_data)
+            conn.commit()
+            num_migrated += len(rows)
+            logger.info(f"Migrated {num_migrated} saved routes.")
+        ## ------------------------
+
+    except pymysql.Error as e:
+        if conn:
+            conn.rollback()
+        logger.info(f"An error occurred: {str(e)}")
+    finally:
+        if conn:
+            conn.close()
+            logger.info("Database connection is closed.")
@@ -0,0 +1,256 @@
+"""Ingest GTFS-realtime feeds into in-memory tables for live train times and alert info
+
+A background task periodically reads the feeds in GTFS_RT_FEEDS (URLs or local
+file paths), parses them into pandas tables indexed by stop and route, and
+swaps them in as one snapshot. Routes are then annotated with a join against
+the snapshot instead of extra requests per station.
+
+NYCT trip updates only carry predicted times, never a delay, so steps get the
+predicted departure and arrival times of the next train instead of a delay.
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import structlog
+from google.transit import gtfs_realtime_pb2
+
+from stations import gtfs_route_id
+from utils import get_http_client
+
+logger = structlog.getLogger(__name__)
+
+
+# comma-separated URLs or file paths of GTFS-realtime feeds, e.g.
+# https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-ace
+GTFS_RT_FEEDS = [feed for feed in os.getenv("GTFS_RT_FEEDS", "").split(",") if feed.strip()]
+GTFS_RT_REFRESH_SECONDS = float(os.getenv("GTFS_RT_REFRESH_SECONDS", "30"))
+
+
+TRIP_UPDATE_COLUMNS = ["stop_id", "route_id", "trip_id", "time"]
+NUMERIC_TRIP_UPDATE_COLUMNS = ["time"]
+ALERT_COLUMNS = ["route_id", "stop_id", "header_text"]
+
+
+class RealtimeSnapshot:
+    """Tables of one ingestion of the GTFS-realtime feeds"""
+
+    def __init__(self, trip_updates: pd.DataFrame, alerts: pd.DataFrame, updated_at: Optional[float]=None):
+        self.updated_at = updated_at
+        # subway stop ids carry the direction, e.g. "127N" -> parent station "127"
+        # the direction is kept on trip updates, steps are matched to trips serving
+        # their departure before their arrival, i.e. trains going the right way
+        trip_updates = trip_updates.assign(
+            parent_stop_id=trip_updates["stop_id"].str.replace(r"[NS]$", "", regex=True)
+        )
+        alerts = alerts[alerts["header_text"].notna()]
+        alerts = alerts.assign(stop_id=alerts["stop_id"].str.replace(r"[NS]$", "", regex=True))
+        self.trip_updates = trip_updates
+
+        # stop times of upcoming trains: one row per (trip_id, parent_stop_id)
+        self.upcoming = trip_updates.loc[
+            trip_updates["time"].notna() & (trip_updates["time"] >= (updated_at or 0)),
+            ["trip_id", "route_id", "parent_stop_id", "time"],
+        ]
+        self.route_alerts = alerts[alerts["stop_id"].isna()].groupby("route_id")["header_text"].agg(lambda texts: sorted(set(texts)))
+        self.stop_alerts = alerts[alerts["stop_id"].notna()].groupby("stop_id")["header_text"].agg(lambda texts: sorted(set(texts)))
+
+    @classmethod
+    def empty(cls) -> "RealtimeSnapshot":
+        return cls(
+            pd.DataFrame(
+                {column: pd.Series(dtype="float64" if column in NUMERIC_TRIP_UPDATE_COLUMNS else "object") for column in TRIP_UPDATE_COLUMNS}
+            ),
+            pd.DataFrame({column: pd.Series(dtype="object") for column in ALERT_COLUMNS}),
+        )
+
+
+def _translated_text(translated_string) -> Optional[str]:
+    """Return the English (or else the first) text of a GTFS-realtime TranslatedString"""
+    translations = [t for t in translated_string.translation if t.text]
+    if not translations:
+        return None
+    return next((t.text for t in translations if t.language in ("", "en")), translations[0].text)
+
+
+def _is_active(alert, now: float) -> bool:
+    """Return True if one of the active periods of the alert includes now
+    An alert without active periods is active as long as it is in the feed
+    """
+    if not alert.active_period:
+        return True
+    return any(
+        (not period.start or period.start <= now) and (not period.end or now < period.end)
+        for period in alert.active_period
+    )
+
+
+def parse_feed(content: bytes, now: Optional[float]=None):
+    """Parse a GTFS-realtime FeedMessage into rows of trip updates and alerts
+    Alerts that are not active at now (default: the current time) are dropped,
+    e.g. planned work announced ahead of time
+    """
+    now = time.time() if now is None else now
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    trip_update_rows = []
+    alert_rows = []
+    for entity in feed.entity:
+        if entity.HasField("trip_update"):
+            trip_update = entity.trip_update
+            for stop_time_update in trip_update.stop_time_update:
+                arrival = stop_time_update.arrival if stop_time_update.HasField("arrival") else None
+                departure = stop_time_update.departure if stop_time_update.HasField("departure") else None
+                trip_update_rows.append((
+                    stop_time_update.stop_id,
+                    trip_update.trip.route_id,
+                    trip_update.trip.trip_id,
+                    # predicted time of the train at the stop
+                    arrival.time if arrival is not None and arrival.HasField("time")
+                    else departure.time if departure is not None and departure.HasField("time") else None,
+                ))
+        if entity.HasField("alert"):
+            alert = entity.alert
+            if not _is_active(alert, now):
+                continue
+            # header_text is optional, fall back to description_text and skip alerts without any text
+            header_text = _translated_text(alert.header_text) or _translated_text(alert.description_text)
+            if header_text is None:
+                continue
+            for informed_entity in alert.informed_entity:
+                alert_rows.append((
+                    informed_entity.route_id or None,
+                    informed_entity.stop_id or None,
+                    header_text,
+                ))
+    return trip_update_rows, alert_rows
+
+
+def build_snapshot(contents: List[bytes]) -> RealtimeSnapshot:
+    """Build the realtime tables from the raw content of all feeds"""
+    now = time.time()
+    trip_update_rows = []
+    alert_rows = []
+    for content in contents:
+        feed_trip_update_rows, feed_alert_rows = parse_feed(content, now)
+        trip_update_rows.extend(feed_trip_update_rows)
+        alert_rows.extend(feed_alert_rows)
+    trip_updates = pd.DataFrame(trip_update_rows, columns=TRIP_UPDATE_COLUMNS)
+    for column in NUMERIC_TRIP_UPDATE_COLUMNS:
+        trip_updates[column] = pd.to_numeric(trip_updates[column], errors="coerce").astype("float64")
+    alerts = pd.DataFrame(alert_rows, columns=ALERT_COLUMNS).astype("object")
+    return RealtimeSnapshot(trip_updates, alerts, updated_at=now)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def read_feed(feed: str) -> bytes:
+    """Read a GTFS-realtime feed from a URL or a local file"""
+    if feed.startswith(("http://", "https://")):
+        response = await get_http_client().get(feed)
+        response.raise_for_status()
+        return response.content
+    return await asyncio.to_thread(_read_file, feed)
+
+
+realtime_snapshot = RealtimeSnapshot.empty()
+
+
+async def refresh_realtime_snapshot(feeds: List[str]=GTFS_RT_FEEDS) -> None:
+    """Read all feeds and swap in a new snapshot
+    Feeds that fail are skipped, the snapshot is kept if all of them fail
+    """
+    global realtime_snapshot
+    contents = []
+    for feed in feeds:
+        try:
+            contents.append(await read_feed(feed))
+        except Exception as e:
+            logger.info(f"Failed to read GTFS-realtime feed {feed}: {e}")
+    if not contents:
+        return
+    realtime_snapshot = await asyncio.to_thread(build_snapshot, contents)
+    logger.info(
+        f"Ingested {len(realtime_snapshot.trip_updates)} stop time updates "
+        f"and {len(realtime_snapshot.route_alerts) + len(realtime_snapshot.stop_alerts)} alert groups."
+    )
+
+
+async def run_realtime_ingester(feeds: List[str]=GTFS_RT_FEEDS) -> None:
+    """Refresh the realtime snapshot every GTFS_RT_REFRESH_SECONDS"""
+    while True:
+        try:
+            await refresh_realtime_snapshot(feeds)
+        except Exception as e:
+            logger.info(f"GTFS-realtime ingestion failed: {e}")
+        await asyncio.sleep(GTFS_RT_REFRESH_SECONDS)
+
+
+def get_live_info_from_routes(routes, all_resolved_stations) -> List[List[Dict[str, Any]]]:
+    """Return live train times and alert info for every TRANSIT step of routes
+    all_resolved_stations is returned by get_stations_from_routes and holds
+    the canonical departure and arrival station of every TRANSIT step.
+    The next train of a step is the earliest upcoming trip of its line that
+    stops at the departure station and then at the arrival station.
+    """
+    snapshot = realtime_snapshot
+    rows = []
+    for route_index, (route, resolved_stations) in enumerate(zip(routes, all_resolved_stations)):
+        transit_steps = [
+            (step_index, step) for step_index, step in enumerate(route["legs"][0]["steps"])
+            if step["travel_mode"] == "TRANSIT"
+        ]
+        for (step_index, step), departure, arrival in zip(transit_steps, resolved_stations[::2], resolved_stations[1::2]):
+            rows.append((
+                route_index,
+                step_index,
+                gtfs_route_id(step["transit_details"]["line"]),
+                departure.stop_id if departure is not None else None,
+                arrival.stop_id if arrival is not None else None,
+            ))
+    steps = pd.DataFrame(rows, columns=["route_index", "step_index", "route_id", "departure_stop_id", "arrival_stop_id"])
+    steps = steps.astype({"route_id": "object", "departure_stop_id": "object", "arrival_stop_id": "object"})
+
+    upcoming = snapshot.upcoming
+    trips = steps.merge(
+        upcoming.rename(columns={"parent_stop_id": "departure_stop_id", "time": "next_departure_time"}),
+        on=["departure_stop_id", "route_id"],
+    ).merge(
+        upcoming[["trip_id", "parent_stop_id", "time"]].rename(columns={"parent_stop_id": "arrival_stop_id", "time": "next_arrival_time"}),
+        on=["trip_id", "arrival_stop_id"],
+    )
+    next_trips = (
+        trips[trips["next_departure_time"] < trips["next_arrival_time"]]
+        .sort_values("next_departure_time")
+        .drop_duplicates(["route_index", "step_index"])
+    )
+    steps = steps.merge(
+        next_trips[["route_index", "step_index", "next_departure_time", "next_arrival_time"]],
+        on=["route_index", "step_index"],
+        how="left",
+    )
+    route_alerts = steps["route_id"].map(snapshot.route_alerts)
+    departure_alerts = steps["departure_stop_id"].map(snapshot.stop_alerts)
+    arrival_alerts = steps["arrival_stop_id"].map(snapshot.stop_alerts)
+
+    all_live_info = [[] for _ in routes]
+    for i, step in enumerate(steps.itertuples(index=False)):
+        alerts = []
+        for step_alerts in (route_alerts.iat[i], departure_alerts.iat[i], arrival_alerts.iat[i]):
+            if isinstance(step_alerts, list):
+                alerts.extend(alert for alert in step_alerts if alert not in alerts)
+        all_live_info[step.route_index].append({
+            "step_index": int(step.step_index),
+            "line": None if pd.isna(step.route_id) else step.route_id,
+            "departure_stop_id": None if pd.isna(step.departure_stop_id) else step.departure_stop_id,
+            "arrival_stop_id": None if pd.isna(step.arrival_stop_id) else step.arrival_stop_id,
+            "next_departure_time": None if pd.isna(step.next_departure_time) else int(step.next_departure_time),
+            "next_arrival_time": None if pd.isna(step.next_arrival_time) else int(step.next_arrival_time),
+            "alerts": alerts,
+        })
+    return all_live_info
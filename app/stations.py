@@ -0,0 +1,168 @@
+"""Resolve Google transit stop names to canonical MTA subway stations
+
+The index is loaded once at startup from the stops.txt file of the MTA GTFS
+static subway feed, extended with the routes serving every station (see __main__).
+Google stop names are matched on a normalized name. The line of the step and
+the stop location are used to pick between stations sharing a name (e.g.
+"34 St-Herald Sq" is D17 for the B/D/F/M and R17 for the N/Q/R/W), or to fall
+back to the nearest station when the name does not match at all.
+"""
+import io
+import math
+import os
+import re
+import zipfile
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+import requests
+import structlog
+
+logger = structlog.getLogger(__name__)
+
+
+STATION_STOPS_PATH = os.getenv(
+    "STATION_STOPS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "stops.txt"),
+)
+GTFS_SUBWAY_URL = "https://rrgtfsfeeds.s3.amazonaws.com/gtfs_subway.zip"
+GRID_CELL_DEGREES = 0.005  # roughly 550m of latitude
+NEAREST_STATION_MAX_METERS = float(os.getenv("NEAREST_STATION_MAX_METERS", "300"))
+
+
+class Station(NamedTuple):
+    stop_id: str  # GTFS parent station id, e.g. "128"
+    name: str  # MTA station name, e.g. "34 St-Penn Station"
+    lat: float
+    lng: float
+    routes: Tuple[str, ...] = ()  # GTFS route ids serving the station, e.g. ("1", "2", "3")
+
+
+def gtfs_route_id(line: Dict[str, Any]) -> Optional[str]:
+    """Return the GTFS route_id of a Google transit line, e.g. "1 Line" -> "1" """
+    if line.get("vehicle", {}).get("type") != "SUBWAY" or "short_name" not in line:
+        return None
+    return line["short_name"].removesuffix(" Line").removesuffix(" Train")
+
+
+def normalize_station_name(name: str) -> str:
+    """Normalize a station name so that Google and MTA spellings compare equal
+    e.g. "34 St - Herald Sq" and "34 St-Herald Sq" -> "34 st-herald sq"
+    """
+    name = name.lower().replace("–", "-").replace("—", "-")
+    name = re.sub(r"\s*([-/])\s*", r"\1", name)
+    name = re.sub(r"\b(\d+)(st|nd|rd|th)\b", r"\1", name)
+    name = re.sub(r"\bstreet\b", "st", name)
+    name = re.sub(r"\b(avenue|ave)\b", "av", name)
+    name = re.sub(r"\bsquare\b", "sq", name)
+    name = re.sub(r"[.,']", "", name)
+    return " ".join(name.split())
+
+
+def _distance_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Equirectangular distance, accurate enough within a city"""
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.hypot(x, y)
+
+
+def _grid_cell(lat: float, lng: float) -> Tuple[int, int]:
+    return (int(math.floor(lat / GRID_CELL_DEGREES)), int(math.floor(lng / GRID_CELL_DEGREES)))
+
+
+class StationIndex:
+    """Name and spatial grid index of the MTA subway stations"""
+
+    def __init__(self, stations: List[Station]):
+        self.stations = stations
+        self.by_name: Dict[str, List[Station]] = defaultdict(list)
+        self.grid: Dict[Tuple[int, int], List[Station]] = defaultdict(list)
+        for station in stations:
+            self.by_name[normalize_station_name(station.name)].append(station)
+            self.grid[_grid_cell(station.lat, station.lng)].append(station)
+
+    @classmethod
+    def from_file(cls, path: str) -> "StationIndex":
+        """Load the parent stations of a GTFS stops.txt file
+        Return an empty index if the file does not exist
+        """
+        if not os.path.exists(path):
+            logger.info(f"Station stops file {path} not found, station names are not resolved.")
+            return cls([])
+        stops = pd.read_csv(path, dtype={"stop_id": str, "parent_station": str, "location_type": str})
+        if "location_type" in stops.columns:
+            stops = stops[stops["location_type"] == "1"]
+        if "routes" in stops.columns:
+            routes = [tuple(str(r).split()) if isinstance(r, str) else () for r in stops["routes"]]
+        else:
+            routes = [()] * len(stops)
+        stations = [
+            Station(stop_id, name, float(lat), float(lng), station_routes)
+            for stop_id, name, lat, lng, station_routes in zip(
+                stops["stop_id"], stops["stop_name"], stops["stop_lat"], stops["stop_lon"], routes
+            )
+        ]
+        logger.info(f"Loaded {len(stations)} stations into the station index.")
+        return cls(stations)
+
+    def nearest(
+        self, lat: float, lng: float, max_meters: float=NEAREST_STATION_MAX_METERS, route_id: Optional[str]=None
+    ) -> Optional[Station]:
+        """Return the nearest station within max_meters of the location
+        Stations served by route_id are preferred over closer stations that are not
+        """
+        row, col = _grid_cell(lat, lng)
+        cell_range = int(math.ceil(max_meters / 111000 / GRID_CELL_DEGREES / min(1.0, math.cos(math.radians(lat)))))
+        nearby = []
+        for i in range(row - cell_range, row + cell_range + 1):
+            for j in range(col - cell_range, col + cell_range + 1):
+                for station in self.grid.get((i, j), []):
+                    distance = _distance_meters(lat, lng, station.lat, station.lng)
+                    if distance <= max_meters:
+                        nearby.append((distance, station))
+        nearby = _prefer_route([station for _, station in sorted(nearby)], route_id)
+        return nearby[0] if nearby else None
+
+    def resolve(
+        self, name: str, lat: Optional[float]=None, lng: Optional[float]=None, route_id: Optional[str]=None
+    ) -> Optional[Station]:
+        """Resolve a Google stop name, location, and line to the canonical MTA station"""
+        candidates = _prefer_route(self.by_name.get(normalize_station_name(name), []), route_id)
+        if len(candidates) == 1 or (candidates and (lat is None or lng is None)):
+            return candidates[0]
+        if lat is None or lng is None:
+            return None
+        if candidates:
+            return min(candidates, key=lambda station: _distance_meters(lat, lng, station.lat, station.lng))
+        return self.nearest(lat, lng, route_id=route_id)
+
+
+def _prefer_route(stations: List[Station], route_id: Optional[str]) -> List[Station]:
+    """Keep the stations served by route_id, or all of them if none is"""
+    served = [station for station in stations if route_id is not None and route_id in station.routes]
+    return served or stations
+
+
+station_index = StationIndex.from_file(STATION_STOPS_PATH)
+
+
+if __name__ == "__main__":
+    # download the MTA GTFS static subway feed and save its stops.txt into STATION_STOPS_PATH
+    # with an extra routes column: the routes of all trips stopping at each parent station
+    response = requests.get(GTFS_SUBWAY_URL)
+    response.raise_for_status()
+    with zipfile.ZipFile(io.BytesIO(response.content)) as gtfs_zip:
+        stops = pd.read_csv(gtfs_zip.open("stops.txt"), dtype=str)
+        trips = pd.read_csv(gtfs_zip.open("trips.txt"), dtype=str, usecols=["trip_id", "route_id"])
+        stop_times = pd.read_csv(gtfs_zip.open("stop_times.txt"), dtype=str, usecols=["trip_id", "stop_id"])
+
+    parent_station = stops.set_index("stop_id")["parent_station"].dropna()
+    stop_routes = stop_times.drop_duplicates().merge(trips, on="trip_id")[["stop_id", "route_id"]].drop_duplicates()
+    stop_routes["stop_id"] = stop_routes["stop_id"].map(parent_station).fillna(stop_routes["stop_id"])
+    routes = stop_routes.groupby("stop_id")["route_id"].agg(lambda route_ids: " ".join(sorted(set(route_ids))))
+    stops["routes"] = stops["stop_id"].map(routes)
+
+    os.makedirs(os.path.dirname(STATION_STOPS_PATH), exist_ok=True)
+    stops.to_csv(STATION_STOPS_PATH, index=False)
+    logger.info(f"Saved {len(stops)} stops to {STATION_STOPS_PATH}.")
@@ -1,12 +1,20 @@
 import os
+import asyncio
 import requests
 import json
-from typing import Any, List
+import time
+import hashlib
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
 import pymysql
 import structlog
 import pandas as pd
 
+from stations import station_index, gtfs_route_id
+from admission import upstream_slot, run_blocking_upstream, should_shed, PRIORITY_LOW, UPSTREAM_TIMEOUT
+
 logger = structlog.getLogger(__name__)
 
 
@@ -34,6 +42,31 @@ INSERT_SAVED_ROUTE_COL_ORDER = [
 ]
 
 
+# only used with ROUTE_STORAGE_FORMAT=zlib, the route_blob column is added by migrate.py
+INSERT_SAVED_ROUTE_BLOB_QUERY = """
+    INSERT INTO saved_route (
+        route_id, 
+        source, 
+        destination, 
+        user_id, 
+        query_id, 
+        route_blob
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s
+    );
+"""
+
+
+INSERT_SAVED_ROUTE_BLOB_COL_ORDER = [
+    "route_id", 
+    "source", 
+    "destination", 
+    "user_id", 
+    "query_id", 
+    "route_blob", 
+]
+
+
 INSERT_EMAIL_NOTIFICATION_QUERY = """
     INSERT INTO email_notification (
         notification_id, 
@@ -63,6 +96,95 @@ GET_SAVED_ROUTE_QUERY = """
 """
 
 
+# Storage format of the saved_route.route_blob column.
+# The first byte of every blob is the format version so that rows written
+# with an older format can still be decoded after the format changes.
+# Rows written before route_blob existed keep the route in the json column.
+ROUTE_STORAGE_FORMAT = os.getenv("ROUTE_STORAGE_FORMAT", "json")  # "json" or "zlib"
+ROUTE_FORMAT_RAW_JSON = 0
+ROUTE_FORMAT_ZLIB_DICT_V1 = 1
+
+
+# Preset dictionary for ROUTE_FORMAT_ZLIB_DICT_V1, built from the keys and
+# values that repeat in every Google Directions route (see app/example_route.json).
+# zlib favours matches near the end of the dictionary, so the most frequent
+# fragments come last.
+# NOTE: never edit this dictionary, rows compressed with it depend on it.
+# Add a new format version with a new dictionary instead.
+ROUTE_ZDICT_V1 = (
+    '"overview_polyline": {"points": "'
+    '"warnings": [], "waypoint_order": [], "summary": "", '
+    '"traffic_speed_entry": [], "via_waypoint": []'
+    '"copyrights": "Map data \\u00a92024 Google", '
+    '"bounds": {"northeast": {"lat": 40.8, "lng": -73.9}, "southwest": {"lat": 40.6, "lng": -73.9}}, '
+    '"start_address": ", New York, NY 100", "end_address": ", USA", '
+    '"accessible_places": [{"details": {"place_id": "", "rating": , "user_ratings_total": '
+    '"relevant_reviews": [{"author_name": "", "author_url": "https://www.google.com/maps/contrib/", '
+    '"language": "en", "original_language": "en", "profile_photo_url": "https://lh3.googleusercontent.com/a/", '
+    '"relative_time_description": " ago", "time": , "translated": false}]'
+    '"agencies": [{"name": "MTA New York City Transit", "phone": "1 (718) 330-1234", "url": "http://www.mta.info/"}], '
+    '"vehicle": {"icon": "//maps.gstatic.com/mapfiles/transit/iw2/6/", "local_icon": "", "name": "Subway", "type": "SUBWAY"}'
+    '"line": {"color": "#", "name": " Train", "short_name": "", "text_color": "#ffffff", '
+    '"transit_details": {"arrival_stop": {"location": {"lat": 40.7, "lng": -73.9}, "name": ""}, '
+    '"departure_stop": {"location": {"lat": 40.7, "lng": -73.9}, "name": ""}, '
+    '"headsign": "", "headway": , "num_stops": '
+    '"arrival_time": {"text": " PM", "time_zone": "America/New_York", "value": 17}, '
+    '"departure_time": {"text": " AM", "time_zone": "America/New_York", "value": 17}, '
+    '"html_instructions": "Walk to ", "maneuver": "turn-'
+    '"travel_mode": "TRANSIT"}, {"distance": {"text": " mi", "value": }, '
+    '"travel_mode": "WALKING"}, {"distance": {"text": " ft", "value": }, '
+    '"duration": {"text": " mins", "value": }, '
+    '"end_location": {"lat": 40.7, "lng": -73.9}, '
+    '"polyline": {"points": ""}, '
+    '"start_location": {"lat": 40.7, "lng": -73.9}, '
+).encode("utf-8")
+
+
+def get_insert_saved_route_query() -> Tuple[str, List[str]]:
+    """Return the insert query of the saved_route table and its column order
+    according to ROUTE_STORAGE_FORMAT
+    """
+    if ROUTE_STORAGE_FORMAT == "zlib":
+        return INSERT_SAVED_ROUTE_BLOB_QUERY, INSERT_SAVED_ROUTE_BLOB_COL_ORDER
+    return INSERT_SAVED_ROUTE_QUERY, INSERT_SAVED_ROUTE_COL_ORDER
+
+
+def encode_route(route: Dict[str, Any]) -> Dict[str, Any]:
+    """Encode a route for the saved_route table according to ROUTE_STORAGE_FORMAT
+    Return the value of the route or the route_blob column
+    """
+    route_json = json.dumps(route)
+    if ROUTE_STORAGE_FORMAT != "zlib":
+        return {"route": route_json}
+    return {"route_blob": compress_route_json(route_json)}
+
+
+def compress_route_json(route_json: str) -> bytes:
+    """Compress the route JSON text into a versioned route_blob"""
+    compressor = zlib.compressobj(level=9, zdict=ROUTE_ZDICT_V1)
+    compressed = compressor.compress(route_json.encode("utf-8")) + compressor.flush()
+    return bytes([ROUTE_FORMAT_ZLIB_DICT_V1]) + compressed
+
+
+def decode_route(saved_route_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Decode the route of a saved_route row in place
+    The route_blob column is removed from the row and the route is returned as a dict
+    """
+    route_blob = saved_route_info.pop("route_blob", None)
+    if route_blob is None:
+        saved_route_info["route"] = json.loads(saved_route_info["route"])
+        return saved_route_info
+
+    route_format, payload = route_blob[0], route_blob[1:]
+    if route_format == ROUTE_FORMAT_ZLIB_DICT_V1:
+        decompressor = zlib.decompressobj(zdict=ROUTE_ZDICT_V1)
+        payload = decompressor.decompress(payload) + decompressor.flush()
+    elif route_format != ROUTE_FORMAT_RAW_JSON:
+        raise ValueError(f"Unknown saved route format: {route_format}")
+    saved_route_info["route"] = json.loads(payload)
+    return saved_route_info
+
+
 async def query_table(query, id):
     """Run read query corresponding to the id"""
     try:
@@ -153,43 +275,207 @@ async def request_to_google_maps_service(origin, dest, user_id, mode="transit"):
     # old: http://3.133.129.121
     api_endpoint = "http://18.118.121.175"
     api_endpoint_template = f"{api_endpoint}:5000/routes?origin={query_origin}&destination={query_dest}&mode={mode}&user_id={user_id}"
-    response = requests.get(api_endpoint_template)
+    response = await run_blocking_upstream(requests.get, api_endpoint_template, timeout=UPSTREAM_TIMEOUT)
     return response.json()
 
 
+# Pages of the route history (viewed routes) of the Google Map service are
+# proxied as raw bytes and cached for ROUTE_HISTORY_CACHE_TTL seconds.
+# Serving a page prefetches the next one in the background.
+ROUTE_HISTORY_CACHE_TTL = float(os.getenv("ROUTE_HISTORY_CACHE_TTL", "30"))
+ROUTE_HISTORY_CACHE_MAX_SIZE = 1024
+RouteHistoryKey = Tuple[str, int, int]  # (user_id, page, limit)
+RouteHistoryPage = Tuple[int, bytes, str]  # (status_code, content, media_type)
+_route_history_cache: Dict[RouteHistoryKey, Tuple[float, RouteHistoryPage]] = {}  # key -> (expires_at, page)
+_route_history_inflight: Dict[RouteHistoryKey, "asyncio.Task[RouteHistoryPage]"] = {}
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared async HTTP client"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=UPSTREAM_TIMEOUT)
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """Close the shared async HTTP client"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _fetch_route_history_page(key: RouteHistoryKey) -> RouteHistoryPage:
+    """Request one page of the route history from the Google Map service and cache it"""
+    user_id, page, limit = key
+    api_endpoint = "http://18.118.121.175"
+    api_endpoint_template = f"{api_endpoint}:5000/viewed_routes/page/{page}"
+    async with upstream_slot():
+        response = await get_http_client().get(
+            api_endpoint_template, 
+            params={"limit": limit, "user_id": user_id}, 
+        )
+    route_history_page = (
+        response.status_code, 
+        response.content, 
+        response.headers.get("Content-Type", "application/json"), 
+    )
+    if response.status_code == 200:
+        now = time.monotonic()
+        if len(_route_history_cache) >= ROUTE_HISTORY_CACHE_MAX_SIZE:
+            for expired_key in [k for k, (expires_at, _) in _route_history_cache.items() if expires_at <= now]:
+                del _route_history_cache[expired_key]
+        if len(_route_history_cache) < ROUTE_HISTORY_CACHE_MAX_SIZE:
+            _route_history_cache[key] = (now + ROUTE_HISTORY_CACHE_TTL, route_history_page)
+    return route_history_page
+
+
+def _get_route_history_task(key: RouteHistoryKey) -> "asyncio.Task[RouteHistoryPage]":
+    """Return the in-flight request of the page, starting one if there is none
+    so that concurrent requests and prefetches of the same page share one upstream call
+    """
+    task = _route_history_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_route_history_page(key))
+        _route_history_inflight[key] = task
+
+        def _done(task):
+            _route_history_inflight.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                logger.info(f"Route history request for {key} failed: {task.exception()}")
+
+        task.add_done_callback(_done)
+    return task
+
+
+def _get_cached_route_history_page(key: RouteHistoryKey) -> Optional[RouteHistoryPage]:
+    """Return the cached page if it has not expired"""
+    cached = _route_history_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+async def request_to_route_history_service(user_id: str, limit: int, page: int) -> RouteHistoryPage:
+    """Request one page of the routes queried by the user from the Google Map service
+    Return the status code, raw content, and media type of the upstream response
+    """
+    key = (user_id, page, limit)
+    route_history_page = _get_cached_route_history_page(key)
+    if route_history_page is None:
+        # shield the shared request from the cancellation of this caller
+        route_history_page = await asyncio.shield(_get_route_history_task(key))
+
+    # prefetch the next page in the background, unless upstream calls are already queueing up
+    next_key = (user_id, page + 1, limit)
+    if (
+        route_history_page[0] == 200
+        and _get_cached_route_history_page(next_key) is None
+        and not should_shed(PRIORITY_LOW)
+    ):
+        _get_route_history_task(next_key)
+    return route_history_page
+
+
+def resolve_stop(stop, transit_type, route_id=None):
+    """Resolve a departure/arrival stop of Google transit details to the canonical MTA station"""
+    if transit_type != "SUBWAY":
+        return None
+    location = stop.get("location", {})
+    return station_index.resolve(stop["name"], location.get("lat"), location.get("lng"), route_id)
+
+
 async def get_stations_from_routes(routes):
-    """Return a list of stations for every step of routes"""
+    """Return a list of stations for every step of routes,
+    the transit type of every station, and the canonical MTA station of every station
+    """
     all_stations = []
     all_transit_types = []
+    all_resolved_stations = []
 
     for route in routes:
         stations = []
         transit_types = []
+        resolved_stations = []
         for step in route["legs"][0]["steps"]:
             if step["travel_mode"] == "TRANSIT":
-                stations.append(step["transit_details"]["departure_stop"]["name"])
-                stations.append(step["transit_details"]["arrival_stop"]["name"])
-                transit_types.extend([step["transit_details"]["line"]["vehicle"]["type"]]*2)
+                transit_details = step["transit_details"]
+                transit_type = transit_details["line"]["vehicle"]["type"]
+                route_id = gtfs_route_id(transit_details["line"])
+                for stop in (transit_details["departure_stop"], transit_details["arrival_stop"]):
+                    stations.append(stop["name"])
+                    transit_types.append(transit_type)
+                    resolved_stations.append(resolve_stop(stop, transit_type, route_id))
         all_stations.append(stations)
         all_transit_types.append(transit_types)
-    return all_stations, all_transit_types
+        all_resolved_stations.append(resolved_stations)
+    return all_stations, all_transit_types, all_resolved_stations
+
+
+# Equipment status from the MTA service is cached per station for MTA_STATUS_TTL seconds.
+# The hash of every cached payload is kept so that the ETag of saved route responses
+# only changes when the equipment status of one of their stations actually changes.
+MTA_STATUS_TTL = int(os.getenv("MTA_STATUS_TTL", "60"))
+# keyed on the MTA station name, which is shared by all platforms of a station complex
+# (e.g. D17 and R17 are both "34 St-Herald Sq") and is what the MTA service is queried with
+_mta_status_cache: Dict[str, Tuple[float, Any, str]] = {}  # MTA station name -> (fetched_at, equipments info, content hash)
+
+
+def _get_mta_stations(all_stations, all_transit_types, all_resolved_stations):
+    """Yield the route index, station name, and MTA station name of every subway station"""
+    if all_resolved_stations is None:
+        all_resolved_stations = [
+            [resolve_stop({"name": station}, transit_type) for station, transit_type in zip(stations, transit_types)]
+            for stations, transit_types in zip(all_stations, all_transit_types)
+        ]
+    for route_index, (stations, transit_types, resolved_stations) in enumerate(
+        zip(all_stations, all_transit_types, all_resolved_stations)
+    ):
+        for station, transit_type, resolved_station in zip(stations, transit_types, resolved_stations):
+            if transit_type == "SUBWAY":
+                mta_station = resolved_station.name if resolved_station is not None else station
+                yield route_index, station, mta_station
+
+
+def get_equipment_digest(all_stations, all_transit_types, all_resolved_stations=None, require_fresh=True) -> Optional[str]:
+    """Return a hash of the cached equipment status of all stations of the routes
+    Return None if a station is not cached, or with require_fresh, if its status is older than MTA_STATUS_TTL
+    """
+    now = time.time()
+    digest = hashlib.sha256()
+    for _, _, mta_station in _get_mta_stations(all_stations, all_transit_types, all_resolved_stations):
+        cached = _mta_status_cache.get(mta_station)
+        if cached is None or (require_fresh and now - cached[0] >= MTA_STATUS_TTL):
+            return None
+        digest.update(f"{mta_station}\0{cached[2]}\n".encode("utf-8"))
+    return digest.hexdigest()
 
 
-async def request_to_mta_service(all_stations, all_transit_types):
+async def request_to_mta_service(all_stations, all_transit_types, all_resolved_stations=None):
     """Request from MTA service API to get station equipments status
+    Stations are requested by their canonical MTA station name when they can be resolved, 
+    and the returned info is keyed by the station names of the routes.
+    Stations requested within the last MTA_STATUS_TTL seconds are served from the cache.
     Return equipments info for all routes
     """
-    all_info = []
-    # loop through stations in a particular route
-    for stations, transit_types in zip(all_stations, all_transit_types):
-        info = {}
-        for station, transit_type in zip(stations, transit_types):
-            if station not in info and transit_type == "SUBWAY":
-                query_station = station.replace(" ", "%20")
-                mta_endpoint = f"https://comsw4153-mta-service-973496949602.us-central1.run.app/equipments/{query_station}"
-                equipments_info = requests.get(mta_endpoint, verify=False)
-                info[station] = equipments_info.json()
-        all_info.append(info)
+    all_info = [{} for _ in all_stations]
+    # loop through stations in all routes
+    for route_index, station, mta_station in _get_mta_stations(all_stations, all_transit_types, all_resolved_stations):
+        info = all_info[route_index]
+        if station in info:
+            continue
+        cached = _mta_status_cache.get(mta_station)
+        if cached is not None and time.time() - cached[0] < MTA_STATUS_TTL:
+            info[station] = cached[1]
+            continue
+        query_station = mta_station.replace(" ", "%20")
+        mta_endpoint = f"https://comsw4153-mta-service-973496949602.us-central1.run.app/equipments/{query_station}"
+        equipments_info = await run_blocking_upstream(requests.get, mta_endpoint, verify=False, timeout=UPSTREAM_TIMEOUT)
+        info[station] = equipments_info.json()
+        content_hash = hashlib.sha256(json.dumps(info[station], sort_keys=True).encode("utf-8")).hexdigest()
+        _mta_status_cache[mta_station] = (time.time(), info[station], content_hash)
     return all_info
 
 
@@ -0,0 +1,62 @@
+"""Test per-user rate limiting of the admission control"""
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import admission
+import main
+
+
+@pytest.fixture(autouse=True)
+def single_request_burst(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_BURST", 1)
+    monkeypatch.setattr(admission, "_buckets", {})
+
+
+def test_public_writes_without_user_are_not_rate_limited():
+    for _ in range(3):
+        assert admission.admit("/save-route/", None, "10.0.0.1") is None
+
+
+def test_protected_writes_are_rate_limited_by_subject():
+    assert admission.admit("/protected-save-route/", "user123", "10.0.0.1") is None
+    rejection = admission.admit("/protected-unsave-route/", "user123", "10.0.0.1")
+    assert rejection.status_code == 429
+    # other users behind the same client address are not affected
+    assert admission.admit("/protected-save-route/", "user456", "10.0.0.1") is None
+
+
+def test_reads_without_user_are_rate_limited_by_client_address():
+    assert admission.admit("/query-all-routes-by-user/", None, "10.0.0.1") is None
+    assert admission.admit("/query-all-routes-by-user/", None, "10.0.0.1").status_code == 429
+
+
+def test_rejections_carry_cors_headers():
+    admission.rate_limit("cors-user")
+    response = TestClient(main.app).get(
+        "/query-routes-and-stations/",
+        params={"source": "a", "destination": "b", "user_id": "cors-user"},
+        headers={"Origin": "https://example.com"},
+    )
+    assert response.status_code == 429
+    assert response.headers["Access-Control-Allow-Origin"] == "*"
+    assert "Retry-After" in response.headers
+
+
+def test_protected_write_is_rate_limited_by_jwt_subject(monkeypatch):
+    monkeypatch.setattr(main, "SECRET_KEY", "test-secret")
+    token = jwt.encode({"sub": "jwt-user"}, "test-secret", algorithm=main.ALGORITHM)
+    admission.rate_limit("jwt-user")
+    response = TestClient(main.app).put(
+        "/protected-unsave-route/",
+        params={"route_id": "route123"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 429
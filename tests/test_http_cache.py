@@ -0,0 +1,119 @@
+"""Test response compression, ETags, and conditional GET of saved routes"""
+import json
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+from fastapi.testclient import TestClient
+
+import http_cache
+import main
+import utils
+
+
+with open(os.path.join(APP_DIR, "example_route.json")) as f:
+    ROUTE = json.load(f)["route"]
+
+
+def test_negotiate_encoding_q_values(monkeypatch):
+    monkeypatch.setattr(http_cache, "brotli", None)
+    assert http_cache.negotiate_encoding("gzip, deflate") == "gzip"
+    assert http_cache.negotiate_encoding("gzip;q=0, *") is None
+    assert http_cache.negotiate_encoding("identity") is None
+    assert http_cache.negotiate_encoding("*") == "gzip"
+
+
+def test_negotiate_encoding_prefers_brotli(monkeypatch):
+    monkeypatch.setattr(http_cache, "brotli", object())
+    assert http_cache.negotiate_encoding("gzip;q=0, *") == "br"
+    assert http_cache.negotiate_encoding("gzip, br") == "br"
+    assert http_cache.negotiate_encoding("gzip, br;q=0.5") == "gzip"
+
+
+def test_etag_matches_with_and_without_encoding_suffix():
+    etag = '"abc"'
+    assert http_cache.etag_matches('"abc"', etag)
+    assert http_cache.etag_matches('"abc-gzip"', etag)
+    assert http_cache.etag_matches('"xyz", W/"abc-br"', etag)
+    assert http_cache.etag_matches("*", etag)
+    assert not http_cache.etag_matches('"abcd"', etag)
+    assert not http_cache.etag_matches(None, etag)
+    assert http_cache.encoded_etag(etag, "gzip") == '"abc-gzip"'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    mta_calls = []
+
+    class MTAResponse:
+        def json(self):
+            return {"equipments": [{"equipment": "EL100", "isactive": "Y"}]}
+
+    def fake_get(url, **kwargs):
+        mta_calls.append(url)
+        return MTAResponse()
+
+    async def fake_query_table(query, id):
+        return [{
+            "route_id": "route123",
+            "source": "Columbia University",
+            "destination": "John F. Kennedy International Airport",
+            "user_id": id,
+            "query_id": "query123",
+            "route": json.dumps(ROUTE),
+        }]
+
+    monkeypatch.setattr(utils.requests, "get", fake_get)
+    monkeypatch.setattr(main, "query_table", fake_query_table)
+    monkeypatch.setattr(utils, "_mta_status_cache", {})
+    test_client = TestClient(main.app)
+    test_client.mta_calls = mta_calls
+    return test_client
+
+
+def test_saved_routes_304_while_mta_cache_is_fresh(client):
+    url = "/get-saved-routes-and-stations/?user_id=etag-user"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    etag = response.headers["etag"]
+    assert etag.endswith('-gzip"')
+    num_mta_calls = len(client.mta_calls)
+    assert num_mta_calls > 0
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert len(client.mta_calls) == num_mta_calls
+
+
+def test_saved_routes_304_etag_follows_negotiated_encoding(client):
+    url = "/get-saved-routes-and-stations/?user_id=etag-encoding-user"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    etag = response.headers["etag"]
+
+    response = client.get(url, headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag.removesuffix('-gzip"') + '"'
+    assert "content-encoding" not in response.headers
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.json() == {"Hello": "World"}
+
+
+def test_compressed_body_decodes_to_json(client):
+    response = client.get(
+        "/get-saved-routes-and-stations/?user_id=gzip-user",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert response.headers["content-encoding"] == "gzip"
+    # the test client decodes the gzip body transparently
+    assert response.json()["saved_routes"][0]["route"] == ROUTE
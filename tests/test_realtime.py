@@ -0,0 +1,101 @@
+"""Test GTFS-realtime ingestion from a local feed file"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+from google.transit import gtfs_realtime_pb2
+
+import realtime
+from stations import Station
+
+
+def add_trip(feed, trip_id, stop_times):
+    entity = feed.entity.add(id=trip_id)
+    entity.trip_update.trip.trip_id = trip_id
+    entity.trip_update.trip.route_id = "1"
+    # NYCT trip updates carry predicted times only, no delay
+    for stop_id, stop_time in stop_times:
+        stop_time_update = entity.trip_update.stop_time_update.add(stop_id=stop_id)
+        stop_time_update.arrival.time = stop_time
+        stop_time_update.departure.time = stop_time
+
+
+def build_feed(now: int) -> gtfs_realtime_pb2.FeedMessage:
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+
+    # northbound trains reach 34 St-Penn Station before 116 St, they come first but go the wrong way
+    add_trip(feed, "north1", [("128N", now + 50), ("117N", now + 200)])
+    add_trip(feed, "north2", [("128N", now + 100), ("117N", now + 250)])
+    # southbound trains, the first one has already left 116 St
+    add_trip(feed, "south0", [("117S", now - 60), ("128S", now + 540)])
+    add_trip(feed, "south1", [("117S", now + 300), ("128S", now + 900)])
+    add_trip(feed, "south2", [("117S", now + 600), ("128S", now + 1200)])
+
+    entity = feed.entity.add(id="route-alert")
+    entity.alert.header_text.translation.add(text="1 trains are delayed", language="en")
+    entity.alert.informed_entity.add(route_id="1")
+    entity.alert.active_period.add(start=now - 600, end=now + 600)
+
+    entity = feed.entity.add(id="stop-alert")
+    entity.alert.description_text.translation.add(text="Elevator is out of service")
+    entity.alert.informed_entity.add(stop_id="128")
+
+    # planned work announced ahead of time is not active yet
+    entity = feed.entity.add(id="planned-work")
+    entity.alert.header_text.translation.add(text="No 1 trains this weekend")
+    entity.alert.informed_entity.add(route_id="1")
+    entity.alert.active_period.add(start=now + 86400, end=now + 2 * 86400)
+
+    # header_text and description_text are optional
+    entity = feed.entity.add(id="alert-without-text")
+    entity.alert.informed_entity.add(route_id="1")
+    return feed
+
+
+def test_refresh_realtime_snapshot_from_file(tmp_path):
+    feed_path = tmp_path / "feed.pb"
+    now = int(time.time())
+    feed_path.write_bytes(build_feed(now).SerializeToString())
+    asyncio.run(realtime.refresh_realtime_snapshot([str(feed_path)]))
+
+    with open(os.path.join(APP_DIR, "example_route.json")) as f:
+        route = json.load(f)["route"]
+    num_transit_steps = sum(step["travel_mode"] == "TRANSIT" for step in route["legs"][0]["steps"])
+    # only the first TRANSIT step (1 train) is a subway step
+    resolved_stations = [
+        Station("117", "116 St-Columbia University", 40.807722, -73.96411),
+        Station("128", "34 St-Penn Station", 40.750373, -73.991057),
+    ] + [None] * (2 * num_transit_steps - 2)
+
+    all_live_info = realtime.get_live_info_from_routes([route], [resolved_stations])
+
+    assert len(all_live_info) == 1
+    assert len(all_live_info[0]) == num_transit_steps
+    live_info = all_live_info[0][0]
+    assert live_info["line"] == "1"
+    assert live_info["departure_stop_id"] == "117"
+    assert live_info["arrival_stop_id"] == "128"
+    # the next southbound train, not the earlier northbound ones
+    assert live_info["next_departure_time"] == now + 300
+    assert live_info["next_arrival_time"] == now + 900
+    assert live_info["alerts"] == ["1 trains are delayed", "Elevator is out of service"]
+    for other_live_info in all_live_info[0][1:]:
+        assert other_live_info["line"] is None
+        assert other_live_info["next_departure_time"] is None
+        assert other_live_info["alerts"] == []
+
+
+def test_parse_feed_drops_inactive_alerts():
+    now = int(time.time())
+    content = build_feed(now).SerializeToString()
+    _, alert_rows = realtime.parse_feed(content, now)
+    assert [header_text for _, _, header_text in alert_rows] == ["1 trains are delayed", "Elevator is out of service"]
+    # the planned work is active a day later, the route alert is not anymore
+    _, alert_rows = realtime.parse_feed(content, now + 86400)
+    assert [header_text for _, _, header_text in alert_rows] == ["Elevator is out of service", "No 1 trains this weekend"]
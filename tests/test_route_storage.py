@@ -0,0 +1,64 @@
+"""Test the storage formats of saved_route.route"""
+import json
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+import utils
+
+
+with open(os.path.join(APP_DIR, "example_route.json")) as f:
+    ROUTE = json.load(f)["route"]
+
+
+def saved_route_row(route=None, route_blob=None):
+    return {
+        "route_id": "route123",
+        "source": "Columbia University",
+        "destination": "John F. Kennedy International Airport",
+        "user_id": "user123",
+        "query_id": "query123",
+        "route": route,
+        "route_blob": route_blob,
+    }
+
+
+def test_zlib_round_trip(monkeypatch):
+    monkeypatch.setattr(utils, "ROUTE_STORAGE_FORMAT", "zlib")
+    encoded = utils.encode_route(ROUTE)
+    assert set(encoded) == {"route_blob"}
+    assert encoded["route_blob"][0] == utils.ROUTE_FORMAT_ZLIB_DICT_V1
+    assert len(encoded["route_blob"]) < len(json.dumps(ROUTE))
+
+    row = utils.decode_route(saved_route_row(route_blob=encoded["route_blob"]))
+    assert row["route"] == ROUTE
+    assert "route_blob" not in row
+
+
+def test_json_format_uses_route_column(monkeypatch):
+    monkeypatch.setattr(utils, "ROUTE_STORAGE_FORMAT", "json")
+    assert utils.encode_route(ROUTE) == {"route": json.dumps(ROUTE)}
+    query, col_order = utils.get_insert_saved_route_query()
+    assert "route_blob" not in query
+    assert col_order == utils.INSERT_SAVED_ROUTE_COL_ORDER
+
+
+def test_decode_legacy_row_without_blob():
+    row = utils.decode_route(saved_route_row(route=json.dumps(ROUTE)))
+    assert row["route"] == ROUTE
+    assert "route_blob" not in row
+
+
+def test_decode_raw_json_blob():
+    route_blob = bytes([utils.ROUTE_FORMAT_RAW_JSON]) + json.dumps(ROUTE).encode("utf-8")
+    row = utils.decode_route(saved_route_row(route_blob=route_blob))
+    assert row["route"] == ROUTE
+
+
+def test_decode_unknown_format_version():
+    with pytest.raises(ValueError):
+        utils.decode_route(saved_route_row(route_blob=b"\xff{}"))
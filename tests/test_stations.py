@@ -0,0 +1,72 @@
+"""Test resolving Google stop names to canonical MTA stations"""
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+import pytest
+
+from stations import NEAREST_STATION_MAX_METERS, StationIndex, gtfs_route_id, normalize_station_name
+
+STOPS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "stops.txt")
+
+
+@pytest.fixture
+def index():
+    return StationIndex.from_file(STOPS_PATH)
+
+
+def test_from_file_loads_parent_stations_with_routes(index):
+    assert len(index.stations) == 9
+    assert index.resolve("116 St-Columbia University").routes == ("1",)
+
+
+@pytest.mark.parametrize("google_name, mta_name", [
+    ("34 St - Herald Sq", "34 St-Herald Sq"),
+    ("34th Street – Herald Square", "34 St-Herald Sq"),
+    ("Times Sq - 42 St", "Times Sq-42 St"),
+    ("Times Square-42nd Street", "Times Sq-42 St"),
+    ("116 St - Columbia University", "116 St-Columbia University"),
+])
+def test_normalize_station_name(google_name, mta_name):
+    assert normalize_station_name(google_name) == normalize_station_name(mta_name)
+
+
+@pytest.mark.parametrize("short_name, stop_id", [
+    ("B", "D17"), ("M", "D17"), ("N", "R17"), ("W", "R17"),
+])
+def test_resolve_herald_sq_by_line(index, short_name, stop_id):
+    line = {"short_name": short_name, "vehicle": {"type": "SUBWAY"}}
+    # both platforms are about 15m apart, only the line tells them apart
+    station = index.resolve("34 St - Herald Sq", 40.74964, -73.98789, gtfs_route_id(line))
+    assert station.stop_id == stop_id
+
+
+@pytest.mark.parametrize("short_name, stop_id", [
+    ("1 Line", "127"), ("7 Train", "725"), ("Q", "R16"), ("GS", "902"),
+])
+def test_resolve_times_sq_by_line(index, short_name, stop_id):
+    line = {"short_name": short_name, "vehicle": {"type": "SUBWAY"}}
+    assert index.resolve("Times Sq - 42 St", 40.7553, -73.9872, gtfs_route_id(line)).stop_id == stop_id
+
+
+def test_resolve_same_name_by_location_without_line(index):
+    assert index.resolve("34 St - Penn Station", 40.7523, -73.9933).stop_id == "A28"
+    assert index.resolve("34 St - Penn Station", 40.7504, -73.9910).stop_id == "128"
+
+
+def test_resolve_unknown_name_falls_back_to_nearest(index):
+    # about 100m north of 116 St-Columbia University
+    assert index.resolve("Columbia University", 40.8086, -73.9637).stop_id == "117"
+    # prefer a station of the line over a closer one
+    assert index.resolve("Herald Square", 40.74972, -73.98782, "N").stop_id == "R17"
+
+
+def test_nearest_within_max_meters(index):
+    # 0.002 degrees of latitude is about 220m
+    assert index.nearest(40.807722 + 0.002, -73.96411).stop_id == "117"
+    assert index.nearest(40.807722 + 0.002, -73.96411, max_meters=100) is None
+    # about 1km away from any station
+    assert index.resolve("Unknown", 40.8167, -73.96411) is None
+    assert NEAREST_STATION_MAX_METERS < 1000